@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 import socket
 import json
+import codecs
 import signal
+import selectors
 import sys
-import time
 import pathlib
 import os
 import os.path
 from string import Formatter
+from collections import namedtuple
+from functools import lru_cache
 from inotify_simple import INotify, flags
 
 RECV_CHUNK = 32768  # Max size of bytes to read from the socket.
@@ -30,17 +33,136 @@ default_custom_values = {
 }
 
 
-def wait():
-    "Hacky solution for some bugs relating to socket connections."
-    time.sleep(0.1)
+def compile_transform(format_spec, conversion):
+    """Compile a field's format spec and conversion into a callable.
+
+Returns None for a bare placeholder like {name}, so callers can keep filling
+those slots with the value as-is; anything like {name:>10} or {name!r} gets a
+closure applying the same conversion and spec str.format would have.
+"""
+    if not format_spec and not conversion:
+        return None
+    convert = {'s': str, 'r': repr, 'a': ascii, None: None}[conversion]
+    if convert is None:
+        return lambda value: format(value, format_spec)
+    if not format_spec:
+        return convert
+    return lambda value: format(convert(value), format_spec)
+
+
+def parse_format(format_str):
+    """Parse a format string into its parts.
+
+str.format re-parses its template on every call, so the parse is done once at
+config time instead. Returns a list of literal and field parts that joins
+into the output, along with a map of field names to (index, transform) pairs
+describing where in that list their values belong and how to transform them
+(None for bare placeholders).
+"""
+    parts = []
+    slots = {}
+    for literal, field, format_spec, conversion in Formatter().parse(
+            format_str):
+        if literal:
+            parts.append(literal)
+        if field is not None:
+            slots.setdefault(field, []).append(
+                (len(parts), compile_transform(format_spec, conversion)))
+            parts.append('')
+    return parts, slots
+
+
+def compile_prop_format(format_str):
+    "Compile a property format string into a closure taking the value."
+    parts, slots = parse_format(format_str)
+    indices = slots.get('prop', [])
+
+    def fmt(value):
+        for i, transform in indices:
+            parts[i] = value if transform is None else transform(value)
+        return ''.join(parts)
+    return fmt
+
+
+def compile_name_lookup(names):
+    """Compile a name-to-index lookup function over the given property names.
+
+For the handful of properties a format string typically holds, a chain of
+identity compares beats a dict lookup, which has to hash the name first. The
+names are expected to be interned (as are the names coming out of
+bucket_newest_data, making `is` reliable); unknown names return -1. The chain
+is generated and compiled at config time, with the names bound as default
+arguments so the compares read local variables.
+"""
+    args = ', '.join('_n{0}=names[{0}]'.format(i) for i in range(len(names)))
+    body = '\n'.join('    if name is _n{0}: return {0}'.format(i)
+                     for i in range(len(names)))
+    src = ('def lookup(name, {}):\n{}\n    return -1\n'.format(args, body))
+    namespace = {'names': names}
+    exec(compile(src, '<lookup>', 'exec'), namespace)
+    return namespace['lookup']
 
 
-def format_property(prop_custom, prop_value):
-    "Form prop_value according to its customification."
-    if prop_custom['as_int']:
-        prop_value = str(int(prop_value))
+# Per-property configuration laid out as parallel tuples, so the observer
+# loop indexes directly instead of chasing nested dict lookups per event.
+CompiledConfig = namedtuple('CompiledConfig', [
+    'names', 'max_lens', 'shorten_strs', 'replace_gets', 'fmts', 'converters',
+    'slots', 'lookup', 'observe_request'])
 
-    replace_val = prop_custom['replace'].get(prop_value)
+# The compiled configuration, set once at startup by compile_config.
+_compiled = None
+
+
+def compile_config(config):
+    """Compile the fixed configuration into its struct-of-arrays form.
+
+Must be called after fix_config. The result is also stored module-wide so
+format_property can reach it without threading it through every call.
+"""
+    global _compiled
+    # The memoized formatting results belong to the old configuration.
+    format_property.cache_clear()
+    custom = config['custom']
+    # Deduplicate while keeping order; a property used twice in the format
+    # string still has a single spec (and multiple bar slots). The names are
+    # interned so comparisons against the (equally interned) names from
+    # incoming events are pointer compares.
+    names = tuple(sys.intern(n)
+                  for n in dict.fromkeys(get_requested_properties(config)))
+    _compiled = CompiledConfig(
+        names=names,
+        max_lens=tuple(custom[n]['max_length'] for n in names),
+        shorten_strs=tuple(custom[n]['shorten_str'] for n in names),
+        # Bind the replacement lookup and the value conversion per property
+        # up front, so format_property dispatches through them without
+        # re-reading and branching on the spec for every event.
+        replace_gets=tuple(custom[n]['replace'].get for n in names),
+        fmts=tuple(custom[n]['_fmt'] for n in names),
+        converters=tuple((lambda v: str(int(v))) if custom[n]['as_int']
+                         else (lambda v: v) for n in names),
+        slots=tuple(config['_bar_slots'][n] for n in names),
+        lookup=compile_name_lookup(names),
+        # Observe commands never change after startup, so the wire bytes are
+        # built once instead of on every reconnect. All commands are
+        # concatenated so that one send covers the whole batch.
+        observe_request=b''.join(
+            observe_payload(n, config['client_id'], custom[n]['as_int'])
+            for n in names),
+    )
+    return _compiled
+
+
+@lru_cache(maxsize=256)
+def format_property(prop_idx, prop_value):
+    """Form prop_value according to its customification.
+
+Properties often repeat the same raw values (volume staying at 50, loop-file
+toggling between yes/no), so the results are memoized; formatting only
+actually runs when a new (property, value) pair shows up.
+"""
+    cfg = _compiled
+    prop_value = cfg.converters[prop_idx](prop_value)
+    replace_val = cfg.replace_gets[prop_idx](prop_value)
     if replace_val is not None:
         prop_value = replace_val
 
@@ -49,60 +171,150 @@ def format_property(prop_custom, prop_value):
     if replace_val == '':
         return ''
 
-    max_len = prop_custom['max_length']
+    max_len = cfg.max_lens[prop_idx]
     is_too_long = len(prop_value) > max_len
-    shortened = ((prop_value[:max_len] + prop_custom['shorten_str'])
+    shortened = ((prop_value[:max_len] + cfg.shorten_strs[prop_idx])
                  if is_too_long else prop_value)
-    formatted = prop_custom['format'].format(prop=shortened)
+    formatted = cfg.fmts[prop_idx](shortened)
     return formatted
 
 
-def observe(sock, prop, client_id, native=False):
-    """Observe the given property. By default all properties will be strings,
-    but with the named argument 'native' set to True, return the property in
-    its native form.
+def observe_payload(prop, client_id, native=False):
+    """Build the wire bytes observing the given property. By default all
+    properties will be strings, but with the named argument 'native' set to
+    True, the property is reported in its native form.
     """
     cmd = 'observe_property' if native else 'observe_property_string'
     str = json.dumps({
         'command': [cmd, client_id, prop]
     }) + '\n'
-    sock.sendall(str.encode('UTF-8'))
+    return str.encode('UTF-8')
+
+
+# Reused decoder instances; slightly cheaper than going through the
+# module-level json.loads (and the per-call error-handler setup of
+# bytes.decode) for every frame. Frames are only decoded to str here, after
+# the property-change prefilter, so uninteresting events never reach the
+# codec at all.
+_decoder = json.JSONDecoder()
+_utf8_decode = codecs.getincrementaldecoder('UTF-8')('ignore').decode
+
+
+def _loads_lenient(frame):
+    "Parse a single JSON frame given as bytes."
+    # Make sure no errors are raised when decoding due to strange
+    # encodings. final=True keeps the decoder stateless across frames.
+    return _decoder.decode(_utf8_decode(frame, True))
+
+
+try:
+    # orjson is a native extension that decodes the small objects mpv sends
+    # a few times faster than the stdlib, and takes bytes directly so frames
+    # need no str decode at all.
+    from orjson import loads as _orjson_loads
+except ImportError:
+    _loads = _loads_lenient
+else:
+    def _loads(frame):
+        "Parse a single JSON frame given as bytes."
+        try:
+            return _orjson_loads(frame)
+        except ValueError:
+            # orjson insists on valid UTF-8, which mpv's IPC doesn't
+            # guarantee for metadata; retry such frames through the lenient
+            # stdlib path instead of dropping them.
+            return _loads_lenient(frame)
+
+
+def drain_frames(rbuf, end):
+    """Parse complete newline-terminated JSON frames from the receive buffer.
+
+Takes the buffer and the offset one past the last received byte. A recv
+boundary may fall in the middle of a line, so any partial frame at the end is
+moved to the front of the buffer to be completed by a later recv. Returns the
+parsed JSON objects along with the new end offset.
+
+Only property-change frames are of interest, and mpv emits plenty of other
+events (seek, playback-restart, ...), so frames are prefiltered with a cheap
+bytes search before paying for a full JSON parse.
+"""
+    events = []
+    start = 0
+    while True:
+        nl = rbuf.find(b'\n', start, end)
+        if nl < 0:
+            break
+        if rbuf.find(b'"property-change"', start, nl) >= 0:
+            try:
+                events.append(_loads(rbuf[start:nl]))
+            except ValueError:
+                # Malformed frame; nothing sensible to do but drop it.
+                pass
+        start = nl + 1
+    if start:
+        # Compact the leftover partial frame to the start of the buffer.
+        rbuf[:end - start] = rbuf[start:end]
+        end -= start
+    return events, end
+
 
+# Cached stdout file descriptor for output(); writing to the fd directly
+# avoids print's formatting overhead and its separate payload/newline writes.
+_STDOUT_FD = sys.stdout.fileno()
 
-def get_jsons(str):
-    "Parse a string as a line-delimited list of JSON objects."
-    return list(map(json.loads, str.splitlines()))
 
+def output(msg):
+    "Output the given message as a single write to stdout."
+    os.write(_STDOUT_FD, (msg + '\n').encode('UTF-8'))
 
-def output(str):
-    "Output the given message."
-    print(str, flush=True)
 
+# Sentinel to differentiate between 'no events found' and 'newest data is
+# null' when looking up bucketed property values.
+_MISSING = object()
 
-def get_newest_data(json_list, event, client_id):
-    """Get the newest value for the provided event in the json list.
-Returns None if no new values exist.
+
+def bucket_newest_data(json_list, client_id, lookup, n_props):
+    """Bucket the newest value of each configured property in the json list.
+
+Returns a list indexed like the compiled property names, holding the
+_MISSING sentinel for properties without events. A single pass over the list
+suffices since later events overwrite earlier ones.
 """
-    events = [
-        j for j in json_list
-        if list(map(j.get, ['event', 'id', 'name'])) ==
-        ['property-change', client_id, event]
-    ]
-    if not events:  # No events at all
-        return None
-    else:
-        data = events[-1].get('data')
-        # Use empty string to differentiate between 'no events found' and
-        # 'newest data is null'.
-        return data if data is not None else ''
+    latest = [_MISSING] * n_props
+    for j in json_list:
+        if j.get('event') == 'property-change' and j.get('id') == client_id:
+            name = j.get('name')
+            if name is not None:
+                # The JSON decoder doesn't intern the name strings; interning
+                # here makes the compiled lookup's identity compares against
+                # the configured (interned) names reliable.
+                i = lookup(sys.intern(name))
+                if i >= 0:
+                    latest[i] = j.get('data')
+    return latest
+
+
+def exit_if_signaled(ready, sig_fd, empty_str):
+    """Exit cleanly if the signal wakeup fd is among the ready selector keys.
+
+Empties the bar before exiting, as the old SIGINT handler did, but runs on
+the main loop itself instead of racing whatever syscall the signal happened
+to interrupt.
+"""
+    for key, _ in ready:
+        if key.fileobj == sig_fd:
+            output(empty_str)
+            sys.exit(0)
 
 
-def wait_connect(inotify, sockname, addr):
+def wait_connect(sel, inotify, sockname, addr, sig_fd, empty_str):
     """Wait for the mpv server to start and return the socket.
 
 This is done by using inotify to passively listen for changes to the socket
 file and reconnecting whenever a change occurs. Could be done with a timer as
-well, but this has performance advantages.
+well, but this has performance advantages. Blocking happens in the selector,
+so the kernel only wakes us when the inotify queue has events (or a signal
+arrived).
 """
     while True:
         try:
@@ -110,64 +322,129 @@ well, but this has performance advantages.
             sock.connect(addr)
             return sock
         except ConnectionError:
-            # Socket unavailable; wait for changes to the address.
+            # Socket unavailable; close the failed socket right away instead
+            # of leaving the fd to the garbage collector, then wait for
+            # changes to the address.
+            sock.close()
             found = False
             while not found:
-                for event in inotify.read():
+                exit_if_signaled(sel.select(), sig_fd, empty_str)
+                for event in inotify.read(timeout=0):
                     if event.name == sockname:
                         found = True
-            # Hack; sometimes connection refused otherwise (why?)
-            wait()
+                        # Don't bother draining the rest of the queue; any
+                        # leftover events keep the fd readable and are
+                        # consumed on a later wakeup.
+                        break
 
 
-def request_observers(sock, config):
-    "Send observe requests to mpv based on the properties given."
-    props = get_requested_properties(config)
-    for p in props:
-        as_int = config['custom'][p]['as_int']
-        observe(sock, p, config['client_id'], as_int)
+def request_observers(sock):
+    "Send the precomputed observe requests to mpv in a single send."
+    sock.sendall(_compiled.observe_request)
+
 
+def end_session(sock, end_str):
+    """Tear down the finished session's socket and empty the bar.
 
-def end_session(end_str):
+The socket is shut down and closed explicitly so the next connect always gets
+a fresh socket, rather than depending on when the old one is collected.
+"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        # The peer is already gone; only the close matters.
+        pass
+    sock.close()
     output(end_str)
-    # For some reason, connect() will reuse the old socket unless we wait a bit
-    # (TIME_WAIT state?), resulting in a broken pipe error when sending the
-    # data. This hack ensures that a fresh socket is used.
-    wait()
 
 
-def run_observer(sock, config):
+def run_observer(sel, inotify, sock, config, sig_fd):
     """Main program loop.
 
-Read from the mpv socket until the connection is closed.
-Needs a prop_index that maps property names to indices in
+Read from the mpv socket until the connection is closed. Blocks in the
+selector rather than in recv itself, so that inotify events and signals
+arriving while connected are handled as well.
 """
-    props = get_requested_properties(config)
-    # A map of property names to their formatted values.
-    property_cache = {p: '' for p in props}
-    while True:
-        try:
-            contents = sock.recv(RECV_CHUNK)
-        except ConnectionResetError:
-            end_session(config['empty'])
-            return
-        if not contents:  # Connection closed.
-            end_session(config['empty'])
-            return
-        # Make sure no errors are raised when decoding due to strange
-        # encodings.
-        json_list = get_jsons(contents.decode('UTF-8', 'ignore'))
-        for prop in props:
-            value = get_newest_data(json_list, prop, config['client_id'])
-            if value == '':
-                # If the string is empty the property is no longer available
-                # (an example being a new song having no album title), so it
-                # shouldn't be formatted, since it might show the old name.
-                property_cache[prop] = ''
-            elif value is not None:
-                property_cache[prop] = format_property(config['custom'][prop],
-                                                       value)
-        output(config['format'].format(**property_cache))
+    cfg = _compiled
+    names = cfg.names
+    # The bar as a list of literal and formatted-value parts; only the slots
+    # of changed properties are updated, and the output is a single join. A
+    # fresh copy is taken per session so old values don't leak across
+    # reconnects.
+    bar_parts = list(config['_bar_parts'])
+    # The raw values behind the bar slots, indexed like cfg.names, so
+    # formatting can be skipped when a property is re-reported unchanged.
+    raw_values = [_MISSING] * len(names)
+    # The last string written to stdout; identical updates are dropped so the
+    # status bar isn't redrawn for no-op recvs.
+    last_output = None
+    # Preallocated receive buffer; recv_into writes into it directly, avoiding
+    # a fresh bytes allocation per recv. Any partial frame is kept at the
+    # front between recvs.
+    rbuf = bytearray(RECV_CHUNK * 4)
+    rview = memoryview(rbuf)
+    write_off = 0
+    sel.register(sock, selectors.EVENT_READ)
+    try:
+        while True:
+            if write_off == len(rbuf):
+                # A single frame exceeds the buffer; grow it. The old
+                # memoryview must be released before the bytearray can be
+                # resized.
+                rview.release()
+                rbuf.extend(bytes(len(rbuf)))
+                rview = memoryview(rbuf)
+            ready = sel.select()
+            exit_if_signaled(ready, sig_fd, config['empty'])
+            if not any(key.fileobj is sock for key, _ in ready):
+                # Woken only by inotify (e.g. unrelated files created in the
+                # socket directory); drain those events and keep waiting.
+                inotify.read(timeout=0)
+                continue
+            # The slice is a second export of rbuf and is released explicitly
+            # before anything else happens; a temporary left to the garbage
+            # collector would make the extend() above fail on PyPy, where
+            # unreferenced objects aren't freed promptly.
+            tail = rview[write_off:]
+            try:
+                received = sock.recv_into(tail)
+            except ConnectionResetError:
+                end_session(sock, config['empty'])
+                return
+            finally:
+                tail.release()
+            if not received:  # Connection closed.
+                end_session(sock, config['empty'])
+                return
+            write_off += received
+            json_list, write_off = drain_frames(rbuf, write_off)
+            latest = bucket_newest_data(json_list, config['client_id'],
+                                        cfg.lookup, len(names))
+            changed = False
+            for i in range(len(names)):
+                value = latest[i]
+                if value is _MISSING or value == raw_values[i]:
+                    continue
+                raw_values[i] = value
+                if value is None or value == '':
+                    # If the string is empty the property is no longer
+                    # available (an example being a new song having no album
+                    # title), so it shouldn't be formatted, since it might
+                    # show the old name. Null data is treated the same way.
+                    formatted = ''
+                else:
+                    formatted = format_property(i, value)
+                for slot, transform in cfg.slots[i]:
+                    bar_parts[slot] = (formatted if transform is None
+                                       else transform(formatted))
+                changed = True
+            if changed:
+                new_output = ''.join(bar_parts)
+                if new_output != last_output:
+                    output(new_output)
+                    last_output = new_output
+    finally:
+        sel.unregister(sock)
 
 
 def fix_config(config):
@@ -193,6 +470,20 @@ errors.
         #
         config['custom'][p] = {**default_custom_values,
                                **(config['custom'].get(p) or {})}
+
+    # Precompile the format strings so the hot path never re-parses them. The
+    # top-level format is kept as its parts so the observer loop can update
+    # individual slots and join.
+    config['_bar_parts'], config['_bar_slots'] = parse_format(config['format'])
+    # str.format also applied specs to the initial empty values (padding
+    # them, for instance); pre-fill the transformed slots to match.
+    for entries in config['_bar_slots'].values():
+        for i, transform in entries:
+            if transform is not None:
+                config['_bar_parts'][i] = transform('')
+    for p in props:
+        spec = config['custom'][p]
+        spec['_fmt'] = compile_prop_format(spec['format'])
     return config
 
 
@@ -223,29 +514,38 @@ def run():
             user_config = fix_config(json.load(f))
     else:
         user_config = fix_config(default_config)
-
-    def signal_handler(sig, frame):
-        """Empty the bar before exiting."""
-        output(user_config['empty'])
-        sys.exit(0)
-
-    signal.signal(signal.SIGINT, signal_handler)
+    compile_config(user_config)
+
+    # SIGINT is handled synchronously by the event loops: the interpreter
+    # writes to the wakeup fd on delivery, which the selector picks up. The
+    # handler itself only exists to keep the default KeyboardInterrupt from
+    # being raised at an arbitrary point.
+    sig_read, sig_write = os.pipe()
+    os.set_blocking(sig_write, False)
+    signal.set_wakeup_fd(sig_write)
+    signal.signal(signal.SIGINT, lambda sig, frame: None)
     # Output the placeholder string to begin with.
     output(user_config['empty'])
 
     addr = user_config['socket']
 
     inotify = INotify()
-    watch_flags = flags.CREATE
+    # MOVED_TO covers servers that create the socket elsewhere and rename it
+    # into place atomically, which a plain CREATE watch would miss.
+    watch_flags = flags.CREATE | flags.MOVED_TO
     watch_dir = pathlib.Path(addr).parent
     watch_file = pathlib.Path(addr).stem
     inotify.add_watch(watch_dir, watch_flags)
+    sel = selectors.DefaultSelector()
+    sel.register(inotify.fd, selectors.EVENT_READ)
+    sel.register(sig_read, selectors.EVENT_READ)
     while True:
-        # Using garbage collection to close the socket instead of an explicit
-        # close() call.
-        with wait_connect(inotify, watch_file, addr) as sock:
-            request_observers(sock, user_config)
-            run_observer(sock, user_config)
+        # The with statement closes the socket on the way out, also covering
+        # exits that bypass end_session.
+        with wait_connect(sel, inotify, watch_file, addr, sig_read,
+                          user_config['empty']) as sock:
+            request_observers(sock)
+            run_observer(sel, inotify, sock, user_config, sig_read)
 
 
 if __name__ == "__main__":